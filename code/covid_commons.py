@@ -1,20 +1,41 @@
 #%% IMPORTS
+import os
+import sys
 import json
+import time
+import pickle
+import copy
+import tempfile
+import functools
+from collections import OrderedDict
+import weakref
+from glob import glob
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-import seaborn as sns
-import geopandas as gp
 
-mpl.rcParams.update({
-    'axes.titlesize': 16,
-    'axes.labelsize': 14,
-    'xtick.labelsize': 12,
-    'ytick.labelsize': 12,
-    'legend.fontsize': 13,
-    'legend.title_fontsize': 15,
-})
+# matplotlib, seaborn & geopandas are slow to import & not needed by the data
+# loaders (e.g. in worker processes), so they are imported only on first use:
+# inside the functions that need them, or when accessed as attributes of this
+# module (e.g. `g.plt`), along with the derived constants like `IMP_NAICS`
+LAZY_MODULES = {'plt': 'matplotlib.pyplot', 'mpl': 'matplotlib',
+                'sns': 'seaborn', 'gp': 'geopandas'}
+
+def __getattr__(name):
+    """
+    Import the lazy modules & build the lazy constants on first access.
+    """
+    if name in LAZY_MODULES:
+        import importlib
+        value = importlib.import_module(LAZY_MODULES[name])
+        if name != 'gp':
+            set_plot_style()
+    elif name == 'IMP_NAICS':
+        value = get_imp_naics()
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    globals()[name] = value
+    return value
 
 #%% INPUTS
 
@@ -26,6 +47,8 @@ CODE_DIR = '/Volumes/data/OneDrive - purdue.edu/Purdue/Research/COVID19_Business
 IO = {k: DATA_DIR + '/' + v for k, v in {
     # base directory of the county data (contains folder for each state)
     'cnty_root': 'county_wise',
+    # Parquet copy of the county data, one folder per table (see `CNTY_TABLES`)
+    'cnty_parquet': 'county_parquet',
     # directory containing data of regions (cities)
     'city_root': 'city_wise',
     # info of regions (cities): their counties and COVID-related events
@@ -75,6 +98,12 @@ DWELL_BINS = {
     'exp_hour': [2.5, 12.5, 40, 60] # values for calculation of hourly exposure
 }
 
+# equal-area projection (CONUS Albers) for computing the areas of geometries
+EQUAL_AREA_CRS = 'EPSG:5070'
+
+# map widths (in pixels) for which the simplified geometries are precomputed
+GEOM_LEVELS = [300, 600, 1200]
+
 # no. of income quantiles for analysis
 INC_NBINS = 5
 
@@ -101,29 +130,172 @@ CMAPS = {
 }
 
 # NAICS codes of important industries to be analyzed in the study
-IMP_NAICS = (
-    pd.DataFrame.from_dict({
-        # key = NAICs code, value = [category name, official NAICS name]
-        445110: ['Supermarkets',        'Supermarkets and Other Grocery (except Convenience) Stores'],
-        447110: ['Gas stations',        'Gasoline Stations with Convenience Stores'],
-        531120: ['Malls',               'Lessors of Nonresidential Buildings (except Miniwarehouses)'],
-        611110: ['Schools',             'Elementary and Secondary Schools'],
-        622110: ['Hospitals',           'General Medical and Surgical Hospitals'],
-        624410: ['Daycare centers',     'Child Day Care Services'],
-        # 712190: ['Nature parks',        'Nature Parks and Other Similar Institutions'],
-        713940: ['Fitness centers',     'Fitness and Recreational Sports Centers'],
-        721110: ['Hotels/Motels',       'Hotels (except Casino Hotels) and Motels'],
-        722410: ['Bars/Pubs',           'Drinking Places (Alcoholic Beverages)'],
-        722511: ['Full Restaurants',    'Full-Service Restaurants'],
-        722513: ['Fast food/Takeout',   'Limited-Service Restaurants'],
-        722515: ['Coffee/Snack places', 'Snack and Nonalcoholic Beverage Bars'],
-    }, orient='index')
-    .rename(columns={0: 'category', 1: 'description'})
-    .rename_axis('naics')
-    .sort_values('category')
-    .assign(color = lambda x: sns.color_palette(
-        CMAPS['industries'], x.shape[0]).as_hex())
-)
+# key = NAICs code, value = [category name, official NAICS name]
+# (the full table with colors, `IMP_NAICS`, is built by `get_imp_naics`)
+IMP_NAICS_NAMES = {
+    445110: ['Supermarkets',        'Supermarkets and Other Grocery (except Convenience) Stores'],
+    447110: ['Gas stations',        'Gasoline Stations with Convenience Stores'],
+    531120: ['Malls',               'Lessors of Nonresidential Buildings (except Miniwarehouses)'],
+    611110: ['Schools',             'Elementary and Secondary Schools'],
+    622110: ['Hospitals',           'General Medical and Surgical Hospitals'],
+    624410: ['Daycare centers',     'Child Day Care Services'],
+    # 712190: ['Nature parks',        'Nature Parks and Other Similar Institutions'],
+    713940: ['Fitness centers',     'Fitness and Recreational Sports Centers'],
+    721110: ['Hotels/Motels',       'Hotels (except Casino Hotels) and Motels'],
+    722410: ['Bars/Pubs',           'Drinking Places (Alcoholic Beverages)'],
+    722511: ['Full Restaurants',    'Full-Service Restaurants'],
+    722513: ['Fast food/Takeout',   'Limited-Service Restaurants'],
+    722515: ['Coffee/Snack places', 'Snack and Nonalcoholic Beverage Bars'],
+}
+
+# default matplotlib settings of the figures (see `set_plot_style`)
+RC_PARAMS = {
+    'axes.titlesize': 16,
+    'axes.labelsize': 14,
+    'xtick.labelsize': 12,
+    'ytick.labelsize': 12,
+    'legend.fontsize': 13,
+    'legend.title_fontsize': 15,
+}
+
+#%% INSTRUMENTATION ------------------------------------------------------------
+
+# whether the functions decorated by `instrument` record their runs, and the
+# optional JSON lines file where each record is also appended (which also
+# collects the records of worker processes); see `set_profiling`
+PROFILING = False
+PROFILE_LOG = None
+
+# records of the instrumented runs of this process (see `get_profile`)
+PROFILE = []
+
+def set_profiling(on=True, log=None):
+    """
+    Turn the recording of the instrumented functions on or off.
+    @param on: whether to record the runs
+    @param log: path of a JSON lines file to which the records are appended
+    """
+    global PROFILING, PROFILE_LOG
+    PROFILING, PROFILE_LOG = on, log
+
+def get_profile(log=None, by=None):
+    """
+    Table of the recorded runs of the instrumented functions, either of this
+    process or read from a log file, optionally summed by some columns
+    (e.g. 'stage' or ['city', 'stage']) along with the no. of runs.
+    """
+    df = pd.read_json(log, lines=True) if log else pd.DataFrame(PROFILE)
+    if by is not None and len(df) > 0:
+        df = (df.groupby(by)
+              [['wall', 'cpu', 'rss_mb', 'rows_in', 'rows_out', 'read_mb']]
+              .sum(min_count=1)
+              .assign(runs = df.groupby(by).size())
+              .sort_values('wall', ascending=False))
+    return df
+
+def clear_profile():
+    """
+    Remove the recorded runs of this process.
+    """
+    PROFILE.clear()
+
+def _nrows(x):
+    """
+    No. of rows of a table or array, the total of a list/tuple of them, or
+    those of the primary (i.e., first) table of a dict of them, e.g. `pat`
+    in the output of `load_pat` (the other tables have other row units).
+    """
+    if isinstance(x, (pd.DataFrame, pd.Series, np.ndarray)):
+        return len(x)
+    if isinstance(x, dict):
+        rows = [_nrows(y) for y in x.values()]
+        return next((y for y in rows if y is not None), None)
+    if isinstance(x, (list, tuple)):
+        rows = [_nrows(y) for y in x]
+        rows = [y for y in rows if y is not None]
+        return sum(rows) if len(rows) > 0 else None
+    return None
+
+def _read_bytes():
+    """
+    No. of bytes read by this process so far (None if not available).
+    """
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().io_counters().read_bytes
+    except (ImportError, AttributeError):
+        return None
+
+def _max_rss():
+    """
+    Peak resident memory of this process so far in MB (None if not available).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS & in kilobytes on Linux
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+def _sizeof(x, deep=True):
+    """
+    Memory used by an object in bytes: deep usage for tables & arrays, the
+    sum of the items for containers & the shallow size otherwise.
+    """
+    if isinstance(x, pd.DataFrame):
+        return int(x.memory_usage(index=True, deep=deep).sum())
+    if isinstance(x, pd.Series):
+        return int(x.memory_usage(index=True, deep=deep))
+    if isinstance(x, np.ndarray):
+        return x.nbytes
+    if isinstance(x, PatOD):
+        return x.memory_usage()
+    if isinstance(x, dict):
+        return sys.getsizeof(x) + sum(_sizeof(v, deep) for v in x.values())
+    if isinstance(x, (list, tuple)):
+        return sys.getsizeof(x) + sum(_sizeof(v, deep) for v in x)
+    return sys.getsizeof(x)
+
+def instrument(func):
+    """
+    Decorator recording the wall time, CPU time, increase in the peak memory
+    (RSS), rows of the input & output tables, and bytes read by each run of
+    `func` when profiling is on (see `set_profiling`). The memory & bytes
+    read are of the whole process, so they also include any other threads.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not PROFILING:
+            return func(*args, **kwargs)
+        # name of the city if a city object is passed
+        city = next((x.name for x in args if hasattr(x, 'counties')), None)
+        rows_in = _nrows([x for x in list(args) + list(kwargs.values())
+                          if isinstance(x, (pd.DataFrame, pd.Series))])
+        rss, read = _max_rss(), _read_bytes()
+        wall, cpu = time.perf_counter(), time.process_time()
+        res = func(*args, **kwargs)
+        rec = dict(
+            stage=func.__name__, city=city, pid=os.getpid(),
+            start=pd.Timestamp.now().isoformat(),
+            wall=time.perf_counter() - wall,
+            cpu=time.process_time() - cpu,
+            rss_mb=None if rss is None else _max_rss() - rss,
+            rows_in=rows_in, rows_out=_nrows(res),
+            read_mb=None if read is None else (_read_bytes() - read) / 2**20)
+        PROFILE.append(rec)
+        if PROFILE_LOG is not None:
+            with open(PROFILE_LOG, 'a') as f:
+                f.write(json.dumps(rec) + '\n')
+        return res
+    return wrapper
 
 #%% CITY CLASS ----------------------------------------------------------------
 
@@ -140,11 +312,186 @@ class City:
         self.dir = IO['city_root'] + '/' + self.name_
         self.counties = dict_['counties']
         self.events = dict_['events']
+        # cached row masks of the filtered views of the city's tables
+        self._masks = {}
 
     def __repr__(self):
         return f'<City:{self.name}>'
 
+    # memory accounting & spilling of the least recently used tables to disk
+    # (see `set_memory_budget`): `_lru` holds the sizes of the tables in memory
+    # from the least to the most recently used, `_spilled` the files & sizes
+    # of the tables on disk, `_spill_refs` the `pat` tables of the spilled
+    # sparse OD tables that are not tables of the city (kept in memory)
+    _BOOKKEEPING = ('_lru', '_spilled', '_budget', '_spill_dir')
 
+    def __getattribute__(self, name):
+        lru = object.__getattribute__(self, '__dict__').get('_lru')
+        if lru is not None and name in lru:
+            lru.move_to_end(name)
+        return object.__getattribute__(self, name)
+
+    def __getattr__(self, name):
+        # only called if the attribute is not found, e.g. if it is spilled
+        spilled = self.__dict__.get('_spilled', {})
+        if name not in spilled:
+            raise AttributeError(name)
+        file, _ = spilled.pop(name)
+        value = pd.read_pickle(file)
+        os.remove(file)
+        if isinstance(value, PatOD):
+            if value._pat_src is not None:
+                value.release_pat(self, value._pat_src[1])
+            elif name in self.__dict__.get('_spill_refs', {}):
+                value.pat = self.__dict__['_spill_refs'].pop(name)
+        setattr(self, name, value)
+        return value
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        d = self.__dict__
+        if d.get('_budget') is None or name not in d:
+            return
+        self._drop_spilled(name)
+        if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray, PatOD)):
+            d['_lru'][name] = _sizeof(value)
+            d['_lru'].move_to_end(name)
+            self._enforce_budget(keep=name)
+        else:
+            d['_lru'].pop(name, None)
+
+    def __delattr__(self, name):
+        d = self.__dict__
+        if name in d.get('_spilled', {}):
+            self._drop_spilled(name)
+            return
+        if d.get('_lru') is not None:
+            d['_lru'].pop(name, None)
+        object.__delattr__(self, name)
+
+    def _drop_spilled(self, name):
+        spilled = self.__dict__.get('_spilled', {})
+        if name in spilled:
+            file, _ = spilled.pop(name)
+            if os.path.exists(file):
+                os.remove(file)
+            self.__dict__.get('_spill_refs', {}).pop(name, None)
+
+    def _enforce_budget(self, keep=None):
+        d = self.__dict__
+        lru, budget = d['_lru'], d['_budget']
+        # refresh the sizes since the tables may have grown in place (e.g.
+        # new columns)
+        for name in lru:
+            lru[name] = _sizeof(d[name])
+        total = sum(lru.values())
+        for name in list(lru.keys()):
+            if total <= budget:
+                break
+            if name == keep:
+                continue
+            size = lru.pop(name)
+            value = d.pop(name)
+            # the sparse OD tables refer to `pat`: make them release it so
+            # that its memory is freed (& not pickled along with them)
+            if isinstance(value, PatOD) and value._pat is not None:
+                src = next((k for k, x in d.items() if x is value._pat), None)
+                if src is not None:
+                    value.release_pat(self, src)
+                else:
+                    # `pat` is not a table of the city: keep it in memory &
+                    # only spill the OD arrays referring to it
+                    d.setdefault('_spill_refs', {})[name] = value._pat
+                    value._pat = None
+            for v in d.values():
+                if isinstance(v, PatOD) and v._pat is value:
+                    v.release_pat(self, name)
+            file = os.path.join(d['_spill_dir'], name + '.pickle')
+            pd.to_pickle(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+            d['_spilled'][name] = (file, size)
+            total -= size
+
+    def set_memory_budget(self, mb=None, spill_dir=None):
+        """
+        Keep the tables (data frames, series & arrays) of the city within `mb`
+        MB of memory by spilling the least recently used ones to pickle files
+        in `spill_dir` (a new temporary folder by default) whenever a table is
+        set. A spilled table is read back on its next access, so the city can
+        be used as if all its tables were in memory. Note that the memory of
+        a spilled table is only freed if nothing else refers to it, except
+        the sparse OD tables (`PatOD`) of the city, which release it; the
+        `pat` of a spilled `PatOD` is only spilled as a table of the city.
+        The sizes of the tables are refreshed whenever a table is set, so a
+        table grown in place (e.g. a new column) is only accounted for then.
+        @param mb: memory budget in MB; None turns the budget off (spilled
+        tables stay on disk until accessed)
+        @param spill_dir: folder of the spilled tables, preferably on a fast
+        local disk
+        """
+        d = self.__dict__
+        d.setdefault('_spilled', {})
+        if mb is None:
+            d['_budget'] = d['_lru'] = None
+            return
+        if spill_dir is None:
+            spill_dir = d.get('_spill_dir') or tempfile.mkdtemp(
+                prefix=f'city_{self.key}_')
+        os.makedirs(spill_dir, exist_ok=True)
+        d['_spill_dir'], d['_budget'] = spill_dir, mb * 2**20
+        if d.get('_lru') is None:
+            d['_lru'] = OrderedDict(
+                (k, _sizeof(v)) for k, v in d.items() if not k.startswith('_')
+                and isinstance(v, (pd.DataFrame, pd.Series, np.ndarray, PatOD)))
+        self._enforce_budget()
+
+    def memory_usage(self, deep=True):
+        """
+        Memory used by each attribute of the city in MB, largest first, with
+        the deep usage of the tables (i.e., including the contents of object
+        columns like strings & arrays). The tables spilled to disk (see
+        `set_memory_budget`) are also listed, with their size when spilled,
+        as are the private caches (e.g. `_masks`, `_geom_levels`). The sparse
+        OD tables (`PatOD`) are counted without the `pat` they refer to.
+        """
+        tables = (pd.DataFrame, pd.Series, np.ndarray, PatOD)
+        rows = [(k, type(v).__name__,
+                 len(v) if isinstance(v, tables) else None,
+                 _sizeof(v, deep) / 2**20, False)
+                for k, v in self.__dict__.items() if k not in self._BOOKKEEPING]
+        rows += [(k, 'spilled', None, size / 2**20, True) for k, (_, size)
+                 in self.__dict__.get('_spilled', {}).items()]
+        return (pd.DataFrame(rows, columns=['attr', 'type', 'rows', 'mb',
+                                            'spilled'])
+                .set_index('attr').sort_values('mb', ascending=False))
+
+    # the filters used by the `get_*` views; changing any of them invalidates
+    # the cached row masks
+    @property
+    def imp_zips(self):
+        try:
+            return self.__dict__['_imp_zips']
+        except KeyError:
+            raise AttributeError('imp_zips')
+
+    @imp_zips.setter
+    def imp_zips(self, value):
+        self.__dict__['_imp_zips'] = value
+        self._masks.clear()
+
+    @property
+    def in_hosp_pois(self):
+        try:
+            return self.__dict__['_in_hosp_pois']
+        except KeyError:
+            raise AttributeError('in_hosp_pois')
+
+    @in_hosp_pois.setter
+    def in_hosp_pois(self, value):
+        self.__dict__['_in_hosp_pois'] = value
+        self._masks.clear()
+
+
+@instrument
 def load_pois(city):
     """
     Static information of the city's POIs.
@@ -154,21 +501,44 @@ def load_pois(city):
             .assign(cnty = lambda x: x['cbg'] // 10000000)
             .set_index('poi_id'))
 
-def load_shp_cbg(city):
-    """
-    Shapefile containing info of census block groups (CBGS).
-    """
-    return (gp.read_file(f'{city.dir}/shapefile/{city.name_}_CBG.shp')
+@instrument
+def load_shp_cbg(city, columns=None, cntys=None, bbox=None):
+    """
+    Shapefile containing info of census block groups (CBGS), read through
+    its GeoParquet cache (see `read_geo`).
+    @param columns: list of (lowercase) columns to be read besides the geometry
+    @param cntys: list of county FIPS codes (without state code) to be kept
+    @param bbox: (minx, miny, maxx, maxy) bounding box of the CBGs to be kept
+    """
+    if columns is not None:
+        columns = [x.upper() for x in dict.fromkeys(['geoid', *columns])]
+    filters = [('ALAND', '>', 0)]
+    if cntys is not None:
+        filters.append(('COUNTYFP', 'in', [f'{x:03}' for x in cntys]))
+    return (read_geo(f'{city.dir}/shapefile/{city.name_}_CBG.shp',
+                     columns, bbox, filters)
             .rename(columns=lambda x: x.lower())
-            .astype({'geoid': np.int64})
-            .query('aland > 0'))
+            .astype({'geoid': np.int64}))
 
-def load_shp_cnty(city):
+@instrument
+def load_shp_cnty(city, columns=None):
     """
     Shapefile containing the county borders & info.
     """
-    return gp.read_file(f'{city.dir}/shapefile/{city.name_}_cnty.shp')
+    return read_geo(f'{city.dir}/shapefile/{city.name_}_cnty.shp', columns)
 
+@instrument
+def load_shp_zip(city):
+    """
+    Shapefile of the zip areas used by the city's case data, whose zip
+    code column is named either `zip` or `postalCode`.
+    """
+    return (read_geo(glob(city.dir + '/shapefile_zip/*.shp')[0])
+            .rename(columns={'postalCode': 'zip'})
+            [['zip', 'geometry']]
+            .astype({'zip': np.int32}))
+
+@instrument
 def load_acs(city):
     """
     Relevant attributes of the census data, converted for better use.
@@ -188,6 +558,7 @@ def load_acs(city):
           [y for y in x.columns if y.startswith('frac_')]]
     return x
 
+@instrument
 def load_rt(city):
     """
     Rt and cases data at the county level.
@@ -197,6 +568,7 @@ def load_rt(city):
                     date = lambda x: str2date(x['date']))
             .drop(columns=['state']))
 
+@instrument
 def load_pat(city, pat_vars=['vis_daily', 'vis_hourly', 'dwells']):
     """
     Load the weekly POI patterns data and pop the heavy columns of
@@ -238,6 +610,7 @@ def load_pat(city, pat_vars=['vis_daily', 'vis_hourly', 'dwells']):
                                      columns=DWELL_BINS['names'])
     return res
 
+@instrument
 def load_pat_od(city):
     """
     Weekly POI patterns OD table mapping visitors from home CBG to POI row
@@ -251,6 +624,7 @@ def load_pat_od(city):
                              'home_cbg': 'cbg'})
             .astype({'row_id': np.int32}))
 
+@instrument
 def load_od_zip(city):
     """
     Weekly POI patterns OD table aggregated by zip code of home CBG.
@@ -267,11 +641,71 @@ def load_od_zip(city):
             .reset_index()
             .astype(np.int32))
 
-def load_social_dist(city):
+# columns of the city social distancing table: name in `load_social_dist`
+# output: name in the stored table (see `make_city_data.ipynb`)
+SD_COLS = {
+    'tot_dev': 'nDev_total',
+    'dev_home': 'nDev_home',
+    'time_home': 'med_time_home',
+}
+
+def save_social_dist(city, data=None, dates=DATES):
+    """
+    Write a Parquet copy of the city's social distancing table, sorted by
+    date with about one day per row group, so that `load_social_dist` can
+    read only the required columns & skip the row groups outside the
+    requested dates.
+    @param data: social distancing table; read from its pickle if not given
+    """
+    file = f'{city.dir}/social_dist_{dateRange2str(dates)}'
+    if data is None:
+        data = pd.read_pickle(file + '.pickle')
+    data = data.sort_values(['date', 'orig_cbg'], ignore_index=True)
+    data.to_parquet(file + '.parquet', index=False,
+                    row_group_size=max(data.groupby('date').size().max(), 1))
+
+@instrument
+def load_social_dist(city, cols=list(SD_COLS), dates=None, cbgs=None,
+                     source=None):
     """
     Daily home CBG social distancing metrics (time & % time spent home).
-    """
-    try:
+    With the Parquet copy of the table (see `save_social_dist`), only the
+    given columns & the daily row groups within the dates are read; the CBG
+    filter is applied on the rows read since each row group holds all CBGs.
+    @param cols: output columns, either from `SD_COLS` or any other column
+    of the stored table (kept with its stored name)
+    @param dates: only keep the dates b/w the first & last of these
+    @param cbgs: only keep these home CBGs
+    @param source: table to read, one of 'model' (`model_data_daily.pickle`),
+    'parquet' or 'pickle' (the social distancing table); by default, the
+    first of these that exists & has the columns, as before the Parquet copy
+    """
+    src = [SD_COLS.get(x, x) for x in cols]
+    file = city.dir + '/social_dist_{}'.format(dateRange2str(DATES))
+    if source is None:
+        if (set(cols) <= set(SD_COLS) and
+                os.path.exists(city.dir + '/model_data_daily.pickle')):
+            source = 'model'
+        elif os.path.exists(file + '.parquet'):
+            source = 'parquet'
+        else:
+            source = 'pickle'
+    if dates is not None:
+        dates = pd.to_datetime([dates[0], dates[-1]])
+    if source == 'parquet':
+        filters = []
+        if dates is not None:
+            filters += [('date', '>=', int(dates[0].strftime('%y%m%d'))),
+                        ('date', '<=', int(dates[-1].strftime('%y%m%d')))]
+        if cbgs is not None:
+            filters += [('orig_cbg', 'in', set(int(x) for x in cbgs))]
+        df = pd.read_parquet(file + '.parquet', columns=['date', 'orig_cbg'] + src,
+                             filters=filters or None)
+        dates = cbgs = None
+    elif source == 'model':
+        if not set(cols) <= set(SD_COLS):
+            raise ValueError('`model_data_daily.pickle` only has the columns '
+                             f'{list(SD_COLS)}')
         df = (pd.read_pickle(city.dir + '/model_data_daily.pickle')
               [['nDevices', 'med_time_home', 'prop_at_home']]
               .reset_index()
@@ -279,20 +713,27 @@ def load_social_dist(city):
                                'med_time_home': 'time_home'}))
         df['dev_home'] = df['prop_at_home']*df['tot_dev']
         df = df.drop(columns=['prop_at_home'])
-    except FileNotFoundError:
-        df = pd.read_pickle(city.dir + '/social_dist_{}.pickle'
-                            .format(dateRange2str(DATES)))
-        df = (df[['date', 'orig_cbg', 'nDev_total', 'nDev_home', 'med_time_home']]
-              .rename(columns={'orig_cbg': 'cbg', 'nDev_total': 'tot_dev',
-                               'nDev_home': 'dev_home',
-                               'med_time_home': 'time_home'}))
+        src = cols
+    elif source == 'pickle':
+        df = pd.read_pickle(file + '.pickle')[['date', 'orig_cbg'] + src]
+    else:
+        raise ValueError(f'Invalid social distancing source: {source}')
+    if 'orig_cbg' in df:
+        df = df.rename(columns={'orig_cbg': 'cbg',
+                                **dict(zip(src, cols))})
         df['date'] = int2date(df['date'])
-    df['time_home'] = df['time_home']/60
-    df = (df.set_index(['cbg', 'date'])
-          [['tot_dev', 'dev_home', 'time_home']].dropna()
-          .astype({'dev_home': np.uint16}))
+    if dates is not None:
+        df = df[df['date'].between(dates[0], dates[-1])]
+    if cbgs is not None:
+        df = df[df['cbg'].isin(cbgs)]
+    if 'time_home' in cols:
+        df['time_home'] = df['time_home']/60
+    df = df.set_index(['cbg', 'date'])[cols].dropna()
+    if 'dev_home' in cols:
+        df = df.astype({'dev_home': np.uint16})
     return df
 
+@instrument
 def load_exposure(city, exp_vars=['cei']):
     """
     POI-weekly table containing exposure metrics.
@@ -308,6 +749,7 @@ def load_exposure(city, exp_vars=['cei']):
             .set_index(['date', 'poi_id']))
 
 # load the data of each city
+@instrument
 def load_city_data(city, exclude=['od_zip'],
                    pat_vars=[], exp_vars=['cei']):
     """
@@ -456,11 +898,35 @@ def remove_outliers(series, thresh=0.975):
     """
     return series[series <= series.quantile(thresh)]
 
+def set_plot_style():
+    """
+    Apply the default matplotlib settings of the figures (`RC_PARAMS`).
+    """
+    import matplotlib as mpl
+    mpl.rcParams.update(RC_PARAMS)
+
+def get_imp_naics():
+    """
+    Table of the important industries (`IMP_NAICS_NAMES`) with their
+    category names, descriptions & consistent colors, indexed by NAICS code.
+    Also available as the module attribute `IMP_NAICS`.
+    """
+    import seaborn as sns
+    return (
+        pd.DataFrame.from_dict(IMP_NAICS_NAMES, orient='index')
+        .rename(columns={0: 'category', 1: 'description'})
+        .rename_axis('naics')
+        .sort_values('category')
+        .assign(color = lambda x: sns.color_palette(
+            CMAPS['industries'], x.shape[0]).as_hex())
+    )
+
 def plot_event(events, ax=None, show_labels=True, va='top',
                linecolor='silver', linestyle='-', labelcolor='black'):
     """
     Draw a vertical line on a time series plot for a given list of events.
     """
+    import matplotlib.pyplot as plt
     fig = plt.gcf()
     if ax is None:
         ax = plt.gca()
@@ -481,6 +947,7 @@ def plot_event(events, ax=None, show_labels=True, va='top',
 
 #%% LOAD & PROCESS COMMON DATASETS --------------------------------------------
 
+@instrument
 def load_cities(exclude=['nym']):
     """
     Create the city objects for all cities without loading their heavy data.
@@ -497,6 +964,7 @@ def load_cities(exclude=['nym']):
     return cities
 
 # noinspection PyRedeclaration
+@instrument
 def load_all_pois():
     """
     Load the big table containing the relevant information about all of the
@@ -508,6 +976,7 @@ def load_all_pois():
             .rename(columns={'postal_code': 'zip'})
             .astype({'poi_id': np.int32, 'zip': np.int32}))
 
+@instrument
 def load_all_zips():
     """
     Load the mapping between ZIP codes and census tract codes for the U.S.
@@ -518,6 +987,7 @@ def load_all_zips():
             [['zip', 'state', 'county', 'geoid', 'zpop', 'zarealand']]
             .astype({'zip': np.int32, 'zpop': np.int32}))
 
+@instrument
 def load_all_naics():
     """
     Load the table that contains all the NAICS codes along with their
@@ -529,6 +999,7 @@ def load_all_naics():
             .rename(columns={'code': 'naics', 'title': 'naics_title'})
             [['naics', 'naics_title']])
 
+@instrument
 def map_cbg_zip(cbgs, zips=None, how='inner'):
     """
     Given a series of CBG ids, get their corresponding zip codes.
@@ -547,6 +1018,110 @@ def map_cbg_zip(cbgs, zips=None, how='inner'):
     res = pd.merge(cbg2tract, zip2tract, on='tract', how=how).drop(columns=['tract'])
     return res
 
+def sum_acs_by_zip(acs, zips=None):
+    """
+    Sum the census CBG-level totals over zip codes, along with the
+    population-weighted sums of the vulnerability variables (`VUL_VARS`) and
+    their weights. All these sums are additive, so the sums of parts of a
+    region (e.g. counties) can simply be added before `finalize_acs_zip`.
+    @param acs: CBG-level census table as given by `load_acs`
+    @param zips: ZIP to tract mapping (see `load_all_zips`)
+    """
+    # get the mapping between CBG & zip code
+    zip2cbg = map_cbg_zip(acs.index, zips)
+    # remove 0 population CBGs
+    acs = acs.query('tot_pop > 0').merge(zip2cbg, on='cbg')
+    vals = acs[VUL_VARS].values
+    valid = ~np.isnan(vals)
+    wts = np.where(valid, acs[['tot_pop']].values, 0)
+    sums = pd.concat([
+        acs[['zip', 'tot_pop', 'tot_hh', 'tot_income', 'tot_hh_income']],
+        pd.DataFrame(np.where(valid, vals, 0) * wts, index=acs.index,
+                     columns=['wsum_'+x for x in VUL_VARS]),
+        pd.DataFrame(wts, index=acs.index, columns=['wt_'+x for x in VUL_VARS])
+    ], axis=1)
+    return sums.groupby('zip').sum()
+
+def finalize_acs_zip(sums):
+    """
+    Get the zip-level census variables from the sums of `sum_acs_by_zip`:
+    averages, income classes & population-weighted vulnerability variables.
+    """
+    x = sums[['tot_pop', 'tot_hh', 'tot_income', 'tot_hh_income']].astype(int)
+    x['avg_income'] = x['tot_income']/x['tot_pop']
+    x['avg_hh_income'] = x['tot_hh_income']/x['tot_hh']
+    x['inc_bin'] = get_inc_classes(x['avg_income'])
+    x['hh_inc_bin'] = get_inc_classes(x['avg_hh_income'])
+    x['inc_q'] = x['inc_bin'].cat.codes + 1
+    x['hh_inc_q'] = x['hh_inc_bin'].cat.codes + 1
+    for var in VUL_VARS:
+        wt = sums['wt_'+var]
+        x[var] = (sums['wsum_'+var] / wt).where(wt > 0)
+    return x
+
+def get_acs_by_zip(acs, zips=None):
+    """
+    Aggregate relevant census CBG-level variables over zip codes: totals are
+    summed and the vulnerability variables are averaged weighted by
+    population, all in one grouped sum (ignoring missing values).
+    """
+    return finalize_acs_zip(sum_acs_by_zip(acs, zips))
+
+def repair_cases(cases, cols, dates=[], new_cols={}, key='zip', time='date',
+                 freq='D', fill=True):
+    """
+    Repair the cumulative case series (cases, tests, deaths) of all zips at
+    once. Each column is pivoted into a zip x date matrix over the full date
+    range so that missing dates show up as NaN; the values of the outlier
+    `dates` are also set to NaN. These gaps are then filled by linear
+    interpolation between the neighbouring dates (i.e., average of the
+    previous & next dates for single day gaps).
+    @param cases: long table of case data with one row per (key, time)
+    @param cols: cumulative columns to be repaired
+    @param dates: list of outlier dates whose values are to be replaced
+    @param new_cols: dict of cumulative column -> name of the column of its
+    first difference (new counts) to be computed after the repair; if that
+    column is already in `cases`, its values are kept & only its missing
+    values are filled with the differences
+    @param freq: frequency of the series ('D' for daily, 'W-MON' for weekly)
+    @param fill: whether to also add the rows of the dates missing in the
+    series of a zip; if False, only the rows of `cases` & of the outlier
+    `dates` are returned & the new counts are the differences b/w these rows
+    (so that they still add up to the cumulative counts)
+    @return: long table with columns [key, time] + cols + new cols; the new
+    counts of the first date are NaN (unless given in `cases`)
+    """
+    keys = np.sort(cases[key].unique())
+    times = pd.date_range(cases[time].min(), cases[time].max(), freq=freq)
+    outliers = pd.DatetimeIndex(pd.to_datetime(dates))
+    # rows to be returned
+    kept = (pd.crosstab(cases[key], cases[time])
+            .reindex(index=keys, columns=times, fill_value=0) > 0)
+    kept.loc[:, kept.columns.isin(outliers)] = True
+    res = {}
+    for col in cols:
+        wide = (cases.pivot_table(index=key, columns=time, values=col)
+                .reindex(index=keys, columns=times))
+        wide.loc[:, wide.columns.isin(outliers)] = np.nan
+        wide = wide.interpolate(axis=1, limit_area='inside')
+        if not fill:
+            wide = wide.where(kept)
+        res[col] = wide
+        if col in new_cols:
+            new = new_cols[col]
+            diff = wide.ffill(axis=1).diff(axis=1).where(wide.notna())
+            if new in cases:
+                diff = (cases.pivot_table(index=key, columns=time, values=new,
+                                          dropna=False)
+                        .reindex(index=keys, columns=times).fillna(diff))
+            res[new] = diff
+    index = pd.MultiIndex.from_product([keys, times], names=[key, time])
+    res = pd.DataFrame({k: v.values.ravel() for k, v in res.items()},
+                       index=index)
+    if not fill:
+        res = res[kept.values.ravel()]
+    return res.dropna(how='all', subset=cols).reset_index()
+
 def get_inc_classes(incomes, bins=[], quantile=INC_NBINS):
     """
     Divide the given series of income into classes by either a given quantile
@@ -561,6 +1136,1141 @@ def get_inc_classes(incomes, bins=[], quantile=INC_NBINS):
         return None
 
 
+#%% SPARSE PATTERNS OD --------------------------------------------------------
+
+class PatOD:
+    """
+    Sparse version of the POI patterns table joined with the patterns OD table
+    aggregated by home zip (`odX`). Instead of repeating all the columns of
+    `pat` for each (POI, week, home zip) row, each OD row only stores the
+    position of its (POI, week) row in `pat` along with its home zip & no. of
+    home visitors. The filter flags are stored as packed bitsets.
+    """
+    # names of the columns of `pat` as they appear in the joined table
+    RENAMES = {'visitors': 'poi_visitors', 'zip': 'poi_zip'}
+
+    def __init__(self, pat, od_zip):
+        """
+        @param pat: POI patterns table (row: (POI, week))
+        @param od_zip: patterns OD table aggregated by home zip, as given by
+        `load_od_zip`
+        """
+        self.pat = pat
+        # position of the (row_id, week) key of each OD row in `pat`
+        pat_key = pd.Index(self._key(pat['row_id'], pat['week']))
+        pos = pat_key.get_indexer(self._key(od_zip['row_id'], od_zip['week']))
+        # drop the OD rows that have no matching POI-week (inner join)
+        found = pos >= 0
+        self.idx = pos[found]
+        self.home_zip = od_zip['zip'].values[found].astype(np.int32)
+        self.home_visitors = od_zip['visitors'].values[found].astype(np.int32)
+        self.flags = {}
+
+    # `pat` may be released by the city holding it when the city spills that
+    # table to disk (see `City.set_memory_budget`); it is then read back
+    # through the city on next use
+    @property
+    def pat(self):
+        if self._pat is None:
+            city, name = self._pat_src
+            self._pat = getattr(city(), name)
+            self._pat_src = None
+        return self._pat
+
+    @pat.setter
+    def pat(self, value):
+        self._pat, self._pat_src = value, None
+
+    def release_pat(self, city, name):
+        """
+        Drop the reference to `pat`, which is the attribute `name` of `city`.
+        """
+        self._pat, self._pat_src = None, (weakref.ref(city), name)
+
+    def __getstate__(self):
+        # a released `pat` is not pickled; the city re-links it on reading
+        state = self.__dict__.copy()
+        if self._pat_src is not None:
+            state['_pat_src'] = (None, self._pat_src[1])
+        return state
+
+    def __len__(self):
+        return self.idx.size
+
+    def memory_usage(self):
+        """
+        Bytes used by the OD arrays & flags (excluding the shared `pat`).
+        """
+        return (self.idx.nbytes + self.home_zip.nbytes +
+                self.home_visitors.nbytes +
+                sum(x.nbytes for x in self.flags.values()))
+
+    def __repr__(self):
+        return f'<PatOD: {len(self)} rows over {self.pat.shape[0]} POI-weeks>'
+
+    @staticmethod
+    def _key(row_id, week):
+        return week.values.astype(np.int64) * 2**32 + row_id.values
+
+    def set_filters(self, imp_zips, in_hosp_pois):
+        """
+        Compute the filter flags of the OD rows: `imp_zip` when both the POI
+        & home zips are in `imp_zips` and `out_hosp` when the POI does not lie
+        inside a hospital (i.e., not in `in_hosp_pois`).
+        """
+        poi_imp = self.pat['zip'].isin(imp_zips).values[self.idx]
+        home_imp = np.isin(self.home_zip, np.asarray(imp_zips))
+        out_hosp = ~self.pat['poi_id'].isin(in_hosp_pois).values[self.idx]
+        self.flags['imp_zip'] = np.packbits(poi_imp & home_imp)
+        self.flags['out_hosp'] = np.packbits(out_hosp)
+
+    def mask(self, imp_zips=False, out_hosp=True):
+        """
+        Boolean row mask of the OD rows for the given filter combination, or
+        None if no filter is required.
+        """
+        names = [k for k, v in [('imp_zip', imp_zips),
+                                ('out_hosp', out_hosp)] if v]
+        if len(names) == 0:
+            return None
+        bits = self.flags[names[0]]
+        for name in names[1:]:
+            bits = bits & self.flags[name]
+        return np.unpackbits(bits, count=len(self)).astype(bool)
+
+    def column(self, name, mask=None):
+        """
+        Values of a column of the (virtual) joined table, as an array.
+        """
+        idx = self.idx if mask is None else self.idx[mask]
+        if name in ('home_zip', 'home_visitors'):
+            values = getattr(self, name)
+            return values if mask is None else values[mask]
+        src = {v: k for k, v in self.RENAMES.items()}.get(name, name)
+        return self.pat[src].values[idx]
+
+    def columns(self):
+        """
+        Names of the columns of the (virtual) joined table.
+        """
+        return ([self.RENAMES.get(x, x) for x in self.pat.columns
+                 if x not in ['row_id', 'cnty']] +
+                ['home_zip', 'home_visitors'])
+
+    def to_frame(self, cols=None, imp_zips=False, out_hosp=True):
+        """
+        Materialize (some columns of) the joined table, filtered by the given
+        flags. This gives the same table as the old full merge of `pat` with
+        `od_zip` but only for the requested columns.
+        """
+        mask = self.mask(imp_zips, out_hosp)
+        cols = self.columns() if cols is None else cols
+        return pd.DataFrame({x: self.column(x, mask) for x in cols})
+
+    def agg(self, by, values=['home_visitors'], split=[], maps={},
+            imp_zips=False, out_hosp=True):
+        """
+        Sum values of the joined table over groups without building it.
+        @param by: list of grouping columns; these can be columns of the
+        joined table or keys of `maps`
+        @param values: OD-level columns (e.g. `home_visitors`) to be summed
+        @param split: POI-level columns (e.g. `visits5`, `tot_dwell5`) which
+        are distributed among the home zips of a POI-week in proportion of the
+        no. of home visitors from these zips before being summed
+        @param maps: dict of new column name -> (column, mapping series), e.g.
+        `{'home_inc_q': ('home_zip', acs_zip['hh_inc_q'])}`
+        """
+        mask = self.mask(imp_zips, out_hosp)
+        idx = self.idx if mask is None else self.idx[mask]
+        data = {}
+        for name in by:
+            if name in maps:
+                col, mapping = maps[name]
+                data[name] = mapping.reindex(self.column(col, mask)).values
+            else:
+                data[name] = self.column(name, mask)
+        for name in values:
+            data[name] = self.column(name, mask)
+        if len(split) > 0:
+            vis = self.column('home_visitors', mask).astype(np.float64)
+            # total home visitors of each POI-week in the filtered rows
+            tot_vis = np.bincount(idx, weights=vis, minlength=self.pat.shape[0])
+            share = vis / tot_vis[idx]
+            for name in split:
+                data[name] = self.column(name, mask) * share
+        return pd.DataFrame(data).groupby(by)[list(values) + list(split)].sum()
+
+
+#%% FILTERED VIEWS ------------------------------------------------------------
+
+def _cached(city, key, table, func):
+    """
+    Get the cached object of a city for the given key, computing it with
+    `func` if it is missing or if it was computed for another version of
+    `table` (e.g. after `city.pat` is reassigned).
+    """
+    ref, value = city._masks.get(key, (None, None))
+    if ref is None or ref() is not table:
+        value = func()
+        city._masks[key] = (weakref.ref(table), value)
+    return value
+
+def _row_mask(city, name, imp_zips, out_hosp, zip_col='zip', poi_col='poi_id'):
+    """
+    Cached boolean row mask of a city's table for the given filters.
+    @param name: name of the city attribute containing the table
+    @param zip_col: zip column to be matched with `city.imp_zips`
+    @param poi_col: POI id column (or 'index') to be matched with
+    `city.in_hosp_pois`
+    """
+    table = getattr(city, name)
+
+    def get_mask():
+        mask = np.ones(table.shape[0], dtype=bool)
+        if imp_zips:
+            mask &= table[zip_col].isin(city.imp_zips).values
+        if out_hosp:
+            pois = table.index if poi_col == 'index' else table[poi_col]
+            mask &= ~np.asarray(pois.isin(city.in_hosp_pois))
+        return mask
+
+    return _cached(city, (name, imp_zips, out_hosp), table, get_mask)
+
+def get_pois(city, imp_zips=False, exclude_in_hosp=True):
+    """
+    POIs of a city, optionally only the ones in zips having case data and
+    excluding the POIs that lie inside hospitals.
+    """
+    return city.pois[_row_mask(city, 'pois', imp_zips, exclude_in_hosp,
+                               poi_col='index')]
+
+def get_acs_zip(city, imp_zips=False):
+    """
+    Zip-level census data, optionally only of the zips having case data with
+    the income classes recomputed over these zips.
+    """
+    if not imp_zips:
+        return city.acs_zip
+
+    def get_acs():
+        acs = city.acs_zip.merge(city.imp_zips, on='zip')
+        acs['inc_bin'] = pd.qcut(acs['avg_income'], INC_NBINS)
+        acs['hh_inc_bin'] = pd.qcut(acs['avg_hh_income'], INC_NBINS)
+        acs['inc_q'] = acs['inc_bin'].cat.codes + 1
+        acs['hh_inc_q'] = acs['hh_inc_bin'].cat.codes + 1
+        return acs.set_index('zip')
+
+    return _cached(city, ('acs_zip', True), city.acs_zip, get_acs)
+
+def get_pat(city, imp_zips=False, out_hosp=True):
+    """
+    POI patterns table, optionally only of the POIs in zips having case data
+    and excluding the POIs that lie inside hospitals.
+    """
+    if not imp_zips and not out_hosp:
+        return city.pat
+    return city.pat[_row_mask(city, 'pat', imp_zips, out_hosp)]
+
+def get_od_zip(city, imp_zips=False):
+    """
+    Patterns OD table by home zip, optionally only of the home zips having
+    case data.
+    """
+    if not imp_zips:
+        return city.od_zip
+    return city.od_zip[_row_mask(city, 'od_zip', True, False)]
+
+def prepare_odX(city):
+    """
+    Sparse joined patterns OD table of a city (`city.odX`) with its filter
+    flags computed for the current `imp_zips` & `in_hosp_pois`.
+    """
+    odX = city.odX
+    _cached(city, ('odX',), odX,
+            lambda: odX.set_filters(city.imp_zips, city.in_hosp_pois))
+    return odX
+
+def get_odX(city, imp_zips=False, out_hosp=True, cols=None):
+    """
+    Materialized joined patterns OD table (or only some of its columns),
+    optionally filtered like `get_pat`.
+    """
+    return prepare_odX(city).to_frame(cols, imp_zips, out_hosp)
+
+
+#%% EXPOSURE METRICS ----------------------------------------------------------
+
+def _exposure_chunk(pat, midpoints, include_last_bin):
+    """
+    Compute the POI-daily exposure metrics (RPS, PET & CEI) of a chunk of the
+    patterns table (row: (POI, week)) that already contains the POI info.
+    """
+    n = pat.shape[0]
+    # hourly visits matrix (row: (POI, day), column: hour)
+    viz_mat = np.stack(pat['visits_hourly'].values).reshape(n*7, 24)
+    # convert ones to zeros in this matrix because ones, like zeros, have no
+    # contribution in social contact; converting them to zero ensures that
+    # those ones do not contribute to the hourly social time becoming -ve
+    viz_mat = np.where(viz_mat == 1, 0, viz_mat).astype(np.float64)
+    daily_viz = viz_mat.sum(axis=1)
+    areas = np.repeat(pat['area_sqft'].values, 7)
+
+    # daily RPS
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rps = np.sqrt(viz_mat.sum(1) * np.sqrt(areas) / daily_viz)
+
+    # weekly dwell time distribution matrix for PET
+    distr = np.stack(pat['dwell_bins'].values).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        distr = distr / distr.sum(axis=1)[:, None]
+    # if required, add visits of 1-4 hr & >4 hr with representative point =1 hr
+    if include_last_bin:
+        distr[:, 3] = distr[:, 3] + distr[:, 4]
+    distr = distr[:, :4]
+    d1, d2, d3, d4 = distr.T
+    t1, t2, t3, t4 = midpoints
+    # weekly alpha coefficient (see the PET formula)
+    alpha = (t1 * (d1 ** 2 + 2 * d1 * d2 + 2 * d1 * d3 + 2 * d1 * d4) +
+             t2 * (d2 ** 2 + 2 * d2 * d3 + 2 * d3 * d4) +
+             t3 * (d3 ** 2 + 2 * d3 * d4) +
+             t4 * (d4 ** 2))
+    # weekly beta coefficient (see the PET formula)
+    beta = distr @ np.array(midpoints)
+    # daily averaged social time, casting weekly vectors to daily
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pet = (np.repeat(alpha, 7) * ((viz_mat ** 2).sum(1) / daily_viz) -
+               np.repeat(beta, 7))
+    # clip the rare negative values to 0
+    pet = np.clip(pet, a_min=0, a_max=None)
+    # POI-daily contact exposure index (CEI) (unit: minute-persons per foot)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cei = pet / np.sqrt(areas)
+
+    days = (pd.to_datetime(np.repeat(pat['date'].values, 7).astype(str),
+                           format='%y%m%d') +
+            pd.to_timedelta(np.tile(np.arange(7), n), unit='D'))
+    return (pd.DataFrame({
+        'date': days,
+        'cbg': np.repeat(pat['cbg'].values, 7),
+        'poi_id': np.repeat(pat['poi_id'].values, 7),
+        'naics': np.repeat(pat['naics'].values, 7),
+        'area': areas,
+        'visits': daily_viz,
+        'rps': rps,
+        'pet': pet,
+        'cei': cei})
+        .dropna()
+        .astype({'visits': np.uint16, 'area': np.int32, 'poi_id': np.int32}))
+
+def save_patterns(city, data=None, dates=WEEKS):
+    """
+    Write a Parquet copy of the city's weekly patterns table, sorted by week
+    with one week per row group, so that `get_exposure` can read a few weeks
+    & columns at a time.
+    @param data: patterns table; read from its pickle if not given
+    """
+    file = f'{city.dir}/patterns_{dateRange2str(dates)}'
+    if data is None:
+        data = pd.read_pickle(file + '.pickle')
+    data = data.sort_values(['date', 'poi_id'], ignore_index=True)
+    data.to_parquet(file + '.parquet', index=False,
+                    row_group_size=max(data.groupby('date').size().max(), 1))
+
+def get_exposure(city, midpoints=DWELL_BINS['exp_hour'], include_last_bin=True,
+                 chunk_weeks=4, write=False):
+    """
+    Compute the POI-daily exposure based mobility metrics (RPS, PET & CEI) of
+    a city from the hourly POI visits, POI areas and weekly dwell time
+    distribution, processing a few weeks at a time. Only the chunk being
+    processed is read from the Parquet copy of the patterns table if present
+    (see `save_patterns`); otherwise, the whole pickle is read once. The
+    output is in the format read by `load_exposure`.
+    @param city: city whose `pois` (if set) are in the format of `load_pois`
+    @param midpoints: representative points of required dwell time buckets
+    @param include_last_bin: whether count the visits of the last bucket
+    (>4 hr) as valid visits >1 h. When false, combine visits of bins 1-4 hr &
+    >4 hr into one category with representative point of 1 hr
+    @param chunk_weeks: no. of weeks processed together
+    @param write: whether write the table to the city's `exposure.pickle`
+    (or `exposure4.pickle` if `include_last_bin` is false)
+    """
+    if not hasattr(city, 'pois'):
+        city.pois = load_pois(city)
+    if (city.pois.index.name != 'poi_id' or not {
+            'cbg', 'naics', 'area_sqft', 'includes_parking_lot'}
+            <= set(city.pois.columns)):
+        raise ValueError('`city.pois` must be in the format of `load_pois`')
+    # filter out the POIs whose area includes parking lot
+    pois = (city.pois.query('includes_parking_lot == False')
+            [['cbg', 'naics', 'area_sqft']])
+    # read the chunks of weeks from the Parquet copy of the patterns table if
+    # present (see `save_patterns`), else from the whole pickle
+    cols = ['date', 'poi_id', 'visits_hourly', 'dwell_bins']
+    file = city.dir + '/patterns_' + dateRange2str(WEEKS)
+    if os.path.exists(file + '.parquet'):
+        weeks = pd.read_parquet(file + '.parquet', columns=['date'])['date']
+        read = lambda x: pd.read_parquet(file + '.parquet', columns=cols,
+                                         filters=[('date', 'in', x)])
+    else:
+        pat = pd.read_pickle(file + '.pickle')[cols]
+        weeks = pat['date']
+        read = lambda x: pat[pat['date'].isin(x)]
+    weeks = [int(x) for x in np.sort(weeks.unique())]
+    exp = []
+    for i in range(0, len(weeks), chunk_weeks):
+        chunk = (read(weeks[i: i + chunk_weeks])
+                 .merge(pois, left_on='poi_id', right_index=True))
+        exp.append(_exposure_chunk(chunk, midpoints, include_last_bin))
+    exp = (pd.concat(exp, ignore_index=True)
+           .set_index(['date', 'cbg', 'poi_id', 'naics']))
+    if write:
+        fname = 'exposure' if include_last_bin else 'exposure4'
+        exp.to_pickle(f'{city.dir}/{fname}.pickle')
+    return exp
+
+
+#%% GEOMETRY ------------------------------------------------------------------
+
+# comparison operators of the row filters of `read_geo` (same as pyarrow's)
+GEO_FILTER_OPS = {
+    '==': lambda x, v: x == v, '=': lambda x, v: x == v,
+    '!=': lambda x, v: x != v, '>': lambda x, v: x > v,
+    '>=': lambda x, v: x >= v, '<': lambda x, v: x < v,
+    '<=': lambda x, v: x <= v, 'in': lambda x, v: x.isin(v),
+    'not in': lambda x, v: ~x.isin(v)
+}
+
+def read_geo(file, columns=None, bbox=None, filters=None, rebuild=False):
+    """
+    Read a vector geometry file (e.g. an ESRI shapefile) through its GeoParquet
+    copy, which is written next to it (same name, '.parquet' extension) on the
+    first read or whenever the source file is newer. Only the requested
+    columns are then read, and row groups outside the bounding box or not
+    satisfying the filters are skipped. Without pyarrow, the source file is
+    read directly & the same filters are applied after reading.
+    @param file: path of the source file readable by `gp.read_file`
+    @param columns: list of columns to be read besides the geometry; all if None
+    @param bbox: (minx, miny, maxx, maxy) bounding box, in the CRS of the data
+    @param filters: list of (column, operator, value) conditions, all of which
+    must hold, e.g. [('STATEFP', 'in', ['17', '18']), ('ALAND', '>', 0)]
+    @param rebuild: whether to rewrite the cache even if it is up to date
+    """
+    import geopandas as gp
+    if columns is not None:
+        columns = [x for x in columns if x != 'geometry'] + ['geometry']
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        df = gp.read_file(file, bbox=None if bbox is None else tuple(bbox))
+        for col, op, value in filters or []:
+            df = df[GEO_FILTER_OPS[op](df[col], value)]
+        return df if columns is None else df[columns]
+    cache = os.path.splitext(file)[0] + '.parquet'
+    if (rebuild or not os.path.exists(cache) or
+            os.path.getmtime(cache) < os.path.getmtime(file)):
+        # the TIGER/Line & cartographic files are ordered by their GEOIDs, so
+        # row groups of consecutive rows are already spatially compact
+        gp.read_file(file).to_parquet(cache, index=False, row_group_size=5000,
+                                      write_covering_bbox=True)
+    return gp.read_parquet(cache, columns=columns, filters=filters,
+                           bbox=None if bbox is None else tuple(bbox))
+
+@instrument
+def load_shp_zips(zips=None, columns=None, bbox=None):
+    """
+    Shapefile of the national zip areas (ZCTAs), optionally only of the
+    given zip codes and/or bounding box.
+    @param zips: list of <int> zip codes to be kept
+    @param columns: list of original columns to be read besides the geometry
+    @param bbox: (minx, miny, maxx, maxy) bounding box of the zips to be kept
+    """
+    if columns is not None:
+        columns = list(dict.fromkeys(['ZCTA5CE10', *columns]))
+    filters = None
+    if zips is not None:
+        filters = [('ZCTA5CE10', 'in', [f'{x:05}' for x in set(zips)])]
+    return (read_geo(IO['zips_shp'], columns, bbox, filters)
+            .rename(columns={'ZCTA5CE10': 'zip'})
+            .astype({'zip': np.int32}))
+
+def _union_geoms(geoms):
+    """
+    Unary union of a list of geometries (worker of `build_city_shapefiles`).
+    """
+    from shapely.ops import unary_union
+    return unary_union(geoms)
+
+def build_city_shapefiles(city, write=True, nProcesses=4):
+    """
+    Extract the CBG shapefile of a city from its state shapefiles, reading
+    each state file once (through `read_geo`), and dissolve its CBGs into the
+    county borders with one worker process per county.
+    @param city: target city object
+    @param write: whether to save both layers to the city's shapefile folder
+    @param nProcesses: number of worker processes; serial if 1
+    @return shp_cbg, shp_cnty: <gp.gdf> CBG & county layers of the city
+    """
+    import geopandas as gp
+    # specify how columns are to be aggregated over the county CBGs
+    agg = {'STATEFP': min, 'COUNTYFP': min, 'ALAND': sum, 'AWATER': sum}
+
+    # read each state shapefile once, only for the counties of the city
+    cntys = {}
+    for state_fips, cnty_fips in city.counties.values():
+        cntys.setdefault(state_fips, []).append(f'{cnty_fips:03}')
+    states = {state_fips: read_geo(IO['state_shp'].format(state_fips),
+                                   filters=[('COUNTYFP', 'in', fips)])
+              for state_fips, fips in cntys.items()}
+
+    # CBGs of all the counties, in the order of `city.counties`
+    shp_cbg = [states[state_fips].query(f'COUNTYFP == "{cnty_fips:03}"')
+               for state_fips, cnty_fips in city.counties.values()]
+    shp_cbg = pd.concat(shp_cbg, axis=0, ignore_index=True)
+
+    # filter out the all water CBGs & compute the county unions in parallel
+    land = shp_cbg.query('ALAND > 0')
+    groups = [df for _, df in land.groupby(['STATEFP', 'COUNTYFP'], sort=False)]
+    geoms = [list(df['geometry']) for df in groups]
+    if nProcesses > 1 and len(geoms) > 1:
+        with Pool(min(nProcesses, len(geoms))) as pool:
+            unions = pool.map(_union_geoms, geoms)
+    else:
+        unions = list(map(_union_geoms, geoms))
+    records = pd.DataFrame([df.agg(agg) for df in groups])
+    shp_cnty = gp.GeoDataFrame(gp.GeoSeries(unions, crs=shp_cbg.crs)
+                               .rename('geometry'))
+    for col in agg.keys():
+        shp_cnty[col] = records[col]
+
+    # save both layers to disk
+    if write:
+        dir_ = f'{city.dir}/shapefile'
+        if not os.path.exists(dir_):
+            os.makedirs(dir_)
+        shp_cbg.to_file(f'{dir_}/{city.name_}_CBG.shp')
+        shp_cnty.to_file(f'{dir_}/{city.name_}_cnty.shp')
+
+    return shp_cbg, shp_cnty
+
+def _city_shapes(city):
+    """
+    Zip & CBG polygons of the city, loaded if not already set.
+    """
+    shp_zip = getattr(city, 'shp_zip', None)
+    if shp_zip is None:
+        shp_zip = load_shp_zip(city)
+    shp_cbg = getattr(city, 'shp_cbg', None)
+    if shp_cbg is None:
+        shp_cbg = load_shp_cbg(city, ['geoid'])
+    return shp_zip[['zip', 'geometry']], shp_cbg[['geoid', 'geometry']]
+
+def _locate_points(points, shp, col, batch_size=100000):
+    """
+    Get the value of column `col` of the polygon of `shp` that contains each
+    point, querying the spatial index (STRtree) of `shp` in batches of points.
+    Points outside all polygons get -1; points on shared borders get the
+    first of their polygons (in the order of `shp`).
+    """
+    res = np.full(len(points), -1, np.int64)
+    values = shp[col].values
+    for i in range(0, len(points), batch_size):
+        # `intersects` so that the points on the borders are also matched
+        idx_pt, idx_shp = shp.sindex.query(points[i: i + batch_size],
+                                           predicate='intersects')
+        order = np.lexsort((idx_shp, idx_pt))
+        idx_pt, idx_shp = idx_pt[order], idx_shp[order]
+        first = np.unique(idx_pt, return_index=True)[1]
+        res[i + idx_pt[first]] = values[idx_shp[first]]
+    return res
+
+def get_poi_geo(city, batch_size=100000, rebuild=False):
+    """
+    Assign the city's POIs to the zip areas of its case data & to its CBGs
+    by their coordinates (point-in-polygon), instead of SafeGraph's
+    `postal_code` & `poi_cbg`. The result is cached in the city's folder.
+    @param city: target city object
+    @param batch_size: no. of POIs queried at once
+    @param rebuild: whether to recompute even if the cached table exists
+    @return: table of `zip` & `cbg` indexed by `poi_id` (-1 if not found)
+    """
+    import geopandas as gp
+    file = city.dir + '/poi_geo.pickle'
+    if not rebuild and os.path.exists(file):
+        return pd.read_pickle(file)
+    pois = getattr(city, 'pois', None)
+    if pois is None:
+        pois = load_pois(city)
+    shp_zip, shp_cbg = _city_shapes(city)
+    points = gp.GeoSeries(gp.points_from_xy(pois['lon'], pois['lat']),
+                          crs='EPSG:4326')
+    res = pd.DataFrame({
+        'zip': _locate_points(points.to_crs(shp_zip.crs).values, shp_zip,
+                              'zip', batch_size).astype(np.int32),
+        'cbg': _locate_points(points.to_crs(shp_cbg.crs).values, shp_cbg,
+                              'geoid', batch_size)
+    }, index=pois.index)
+    res.to_pickle(file)
+    return res
+
+def get_cbg_zip_overlay(city, crs=EQUAL_AREA_CRS, rebuild=False):
+    """
+    Area-weighted overlay of the city's CBGs on the zip areas of its case
+    data: for each intersecting (CBG, zip) pair, the area of intersection &
+    its fraction of the CBG area, computed in an equal-area projection.
+    Candidate pairs come from the spatial index of the zips. This can be used
+    in place of the tract-based `map_cbg_zip`. The result is cached in the
+    city's folder.
+    @param city: target city object
+    @param crs: equal-area projection used for the areas
+    @param rebuild: whether to recompute even if the cached table exists
+    @return: long table of `cbg`, `zip`, `area` (sq. m) & `frac`
+    """
+    file = city.dir + '/cbg_zip_overlay.pickle'
+    if not rebuild and os.path.exists(file):
+        return pd.read_pickle(file)
+    shp_zip, shp_cbg = _city_shapes(city)
+    zips = shp_zip.to_crs(crs).reset_index(drop=True)
+    cbgs = shp_cbg.to_crs(crs).reset_index(drop=True)
+    idx_cbg, idx_zip = zips.sindex.query(cbgs.geometry.values,
+                                         predicate='intersects')
+    area = (cbgs.geometry.iloc[idx_cbg].reset_index(drop=True)
+            .intersection(zips.geometry.iloc[idx_zip].reset_index(drop=True))
+            .area.values)
+    res = pd.DataFrame({
+        'cbg': cbgs['geoid'].values[idx_cbg],
+        'zip': zips['zip'].values[idx_zip],
+        'area': area,
+        'frac': area / cbgs.geometry.area.values[idx_cbg]
+    }).query('area > 0').reset_index(drop=True)
+    res.to_pickle(file)
+    return res
+
+def simplify_layer(gdf, pixels):
+    """
+    Simplify the polygons of a layer for a map `pixels` wide, i.e., with a
+    tolerance of one pixel at the layer's extent. The polygons are simplified
+    as a coverage (shared borders stay shared, so no gaps or slivers appear)
+    where supported, else each polygon keeps its own topology.
+    """
+    minx, miny, maxx, maxy = gdf.total_bounds
+    tol = max(maxx - minx, maxy - miny) / pixels
+    geom = gdf.geometry
+    if hasattr(geom, 'simplify_coverage'):
+        return geom.simplify_coverage(tol)
+    return geom.simplify(tol, preserve_topology=True)
+
+def get_layer(city, name, pixels=None, rebuild=False):
+    """
+    Geometry layer of the city (e.g. 'shp_cbg', 'shp_zip') with its polygons
+    simplified for a map `pixels` wide, i.e. at the coarsest level of
+    `GEOM_LEVELS` that is at least that wide (full resolution if `pixels` is
+    None or beyond all the levels). The simplified geometries of all levels
+    are computed on first use & cached in the city's shapefile folder, and are
+    recomputed if the layer's polygons or rows change (checked by their hash
+    when the layer object is not the one last seen).
+    @param city: target city object
+    @param name: attribute of the city containing the layer
+    @param pixels: width of the map in pixels, e.g. from `ax_pixels`
+    @param rebuild: whether to recompute the simplified geometries
+    """
+    layer = getattr(city, name)
+    if pixels is None or pixels > max(GEOM_LEVELS):
+        return layer
+    level = min(x for x in GEOM_LEVELS if x >= pixels)
+    levels = city.__dict__.setdefault('_geom_levels', {})
+    ref, geoms = levels.get(name, (None, None))
+    if rebuild or ref is None or ref() is not layer:
+        file = f'{city.dir}/shapefile/{name}_levels.pickle'
+        key = _hash_key(layer.geometry.to_wkb(), index=True)
+        geoms = None
+        if not rebuild and os.path.exists(file):
+            saved = pd.read_pickle(file)
+            if saved.get('key') == key:
+                geoms = saved['geoms']
+        if geoms is None:
+            geoms = {x: simplify_layer(layer, x) for x in GEOM_LEVELS}
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            pd.to_pickle({'key': key, 'geoms': geoms}, file)
+        levels[name] = (weakref.ref(layer), geoms)
+    return layer.set_geometry(geoms[level])
+
+def ax_pixels(ax):
+    """
+    Width of a matplotlib axis in pixels, used to pick the level of detail
+    of the maps drawn on it (see `get_layer`).
+    """
+    return ax.get_window_extent().width
+
+
+#%% MOBILITY CUBE -------------------------------------------------------------
+
+# dimensions of the cells of the mobility cube: county & week of the POI
+# visits, NAICS code of the POI & income class (`hh_inc_q`) of its zip
+CUBE_DIMS = ['cnty', 'week', 'naics', 'inc_q']
+
+# additive measures of the cells of the mobility cube (`tot_exp`: exposure
+# metric weighted by the exposure visits)
+CUBE_VARS = ['pois', 'visitors', 'visits4', 'visits5', 'tot_dwell4',
+             'tot_dwell5', 'exp_visits', 'tot_exp']
+
+def _cube_cells(pat, inc_q, exp=None, exp_var='cei'):
+    """
+    Sum a part (some weeks) of the patterns table into the cells of the
+    mobility cube.
+    @param pat: POI patterns table with either the dwell bins columns or the
+    visits & total dwell time columns (`visits4/5`, `tot_dwell4/5`)
+    @param inc_q: income class of each zip code
+    @param exp: POI exposure table, daily or weekly (see `update_mob_cube`)
+    """
+    names, avg = DWELL_BINS['names'], np.array(DWELL_BINS['avg'])
+    df = pat[['cnty', 'week', 'naics', 'zip', 'poi_id', 'visitors']].copy()
+    df['visits5'] = pat['visits5' if 'visits5' in pat else 'visits'].values
+    if 'tot_dwell5' in pat:
+        for col in ['visits4', 'tot_dwell4', 'tot_dwell5']:
+            df[col] = pat[col].values
+    else:
+        bins = pat[names].values
+        df['visits4'] = bins[:, :4].sum(1)
+        df['tot_dwell4'] = bins[:, :4] @ avg[:4]
+        df['tot_dwell5'] = bins @ avg
+    # income class of the POI zip (0 if not known)
+    df['inc_q'] = df['zip'].map(inc_q).fillna(0).astype(np.int8).values
+    # weekly exposure of each POI
+    if exp is not None:
+        exp = exp[['exp_visits', exp_var]].reset_index()
+        if 'week' not in exp:
+            dates = pd.Series(exp['date'].unique())
+            weeks = date2int(get_week(int2date(dates)))
+            exp['week'] = exp['date'].map(dict(zip(dates, weeks)))
+        exp['tot_exp'] = exp[exp_var] * exp['exp_visits']
+        exp = exp.groupby(['week', 'poi_id'])[['exp_visits', 'tot_exp']].sum()
+        df = df.merge(exp, 'left', left_on=['week', 'poi_id'],
+                      right_index=True)
+    else:
+        df['exp_visits'] = df['tot_exp'] = np.nan
+    df['pois'] = 1
+    return df.groupby(CUBE_DIMS)[CUBE_VARS].sum(min_count=1)
+
+def _hash_key(x, index=False):
+    """
+    Order-independent hash of the values (& optionally the index) of a
+    series or array, to tell whether a saved result was made from it.
+    """
+    return int(pd.util.hash_pandas_object(pd.Series(x), index=index).sum())
+
+def update_mob_cube(city, imp_zips=False, out_hosp=True, exp=None,
+                    exp_var='cei', name='mob_cube', rebuild=False, write=True):
+    """
+    Get the county x week x NAICS x income class mobility cube of a city,
+    i.e. the POI visits, visitors, total dwell times & exposure summed by
+    these dimensions, adding only the weeks of the patterns table that are
+    not in the cube saved in the city's folder yet (all if `rebuild`). Since
+    the measures are additive, the cube can be queried for any region (list
+    of counties) & combination of dimensions by `query_mob_cube`. The saved
+    cube is rebuilt if it was made with other POI filters, income classes or
+    exposure metric; changes of the data of the saved weeks need `rebuild`.
+    @param city: target city object
+    @param imp_zips, out_hosp: filters of the patterns table (see `get_pat`);
+    the income classes are those of `get_acs_zip(city, imp_zips)`
+    @param exp: POI exposure table, either daily (index: (date, poi_id), as
+    given by `load_exposure`) or weekly (index: (poi_id, week)), with the
+    exposure visits (`exp_visits`) & the metric `exp_var`; none if not given
+    @param name: name of the cube file, e.g. for cubes of filtered tables
+    @param rebuild: whether to recompute the cells of all the weeks
+    @param write: whether to save the updated cube
+    """
+    pat = get_pat(city, imp_zips, out_hosp)
+    inc_q = get_acs_zip(city, imp_zips)['hh_inc_q']
+    key = {'imp_zips': _hash_key(city.imp_zips) if imp_zips else None,
+           'in_hosp_pois': _hash_key(city.in_hosp_pois) if out_hosp else None,
+           'inc_q': _hash_key(inc_q, index=True),
+           'exp_var': exp_var if exp is not None else None}
+    file = f'{city.dir}/{name}.pickle'
+    cube = None
+    if not rebuild and os.path.exists(file):
+        cube = pd.read_pickle(file)
+        if cube.attrs.get('key') != key:
+            print(f'Rebuilding {file} made from other inputs')
+            cube = None
+    weeks = pd.Series(pat['week'].unique())
+    if cube is not None:
+        weeks = weeks[~weeks.isin(cube.index.unique('week'))]
+    if len(weeks) == 0:
+        return cube
+    new = _cube_cells(pat[pat['week'].isin(weeks)], inc_q, exp, exp_var)
+    cube = new if cube is None else pd.concat([cube, new]).sort_index()
+    cube.attrs['key'] = key
+    if write:
+        cube.to_pickle(file)
+    return cube
+
+@instrument
+def load_mob_cube(city, name='mob_cube'):
+    """
+    Mobility cube of a city saved by `update_mob_cube`.
+    """
+    return pd.read_pickle(f'{city.dir}/{name}.pickle')
+
+def query_mob_cube(cube, by=['week'], cntys=None, weeks=None, naics=None,
+                   inc_q=None):
+    """
+    Sum the cells of the mobility cube by some of its dimensions, optionally
+    only for some counties (e.g. of a region), weeks, NAICS codes & income
+    classes. Also add the average dwell times & exposure, and the visits per
+    visitor.
+    @param cube: mobility cube (of one city or concatenated for many)
+    @param by: dimension(s) of `CUBE_DIMS` to group by
+    """
+    for dim, values in zip(CUBE_DIMS, [cntys, weeks, naics, inc_q]):
+        if values is not None:
+            cube = cube[cube.index.get_level_values(dim).isin(
+                np.atleast_1d(values))]
+    return (cube.groupby(by).sum(min_count=1)
+            .assign(avg_dwell4 = lambda x: x['tot_dwell4'] / x['visits4'],
+                    avg_dwell5 = lambda x: x['tot_dwell5'] / x['visits5'],
+                    avg_exp = lambda x: x['tot_exp'] / x['exp_visits'],
+                    visit_ratio = lambda x: x['visits5'] / x['visitors']))
+
+
+#%% SQL LAYER -----------------------------------------------------------------
+
+# tables of the county-wise data exposed as SQL views (see `connect_cnty_db`):
+# view name: (file name in the county folders, whether it is daily/weekly)
+CNTY_TABLES = {
+    'places': ('places', False),
+    'census': ('census', False),
+    'patterns': ('patterns', True),
+    'patterns_od': ('homes', True),
+    'social_dist': ('social_dist', True),
+    'social_od': ('social_od', True),
+}
+
+# connection to the database of the county-wise views (see `query_cnty`)
+CNTY_DB = None
+
+def _pickle_to_parquet(args):
+    """
+    Convert a pickled table to a Parquet file (worker of `export_cnty_parquet`).
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    src, dst = args
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    table = pa.Table.from_pandas(pd.read_pickle(src), preserve_index=False)
+    pq.write_table(table, dst + '.tmp')
+    os.replace(dst + '.tmp', dst)
+
+def export_cnty_parquet(table, root=IO['cnty_root'], out=IO['cnty_parquet'],
+                        overwrite=False, nProcesses=4):
+    """
+    Copy the pickles of a county-wise table to Parquet files, partitioned by
+    state, county & date (hive style, e.g. `patterns/state=17/cnty=31/
+    date=200106/data.parquet`) so that queries on these columns only read
+    the matching files. Only the files not exported yet are converted unless
+    `overwrite`, so this can be rerun as new dates are added.
+    @param table: name of the view in `CNTY_TABLES`
+    @param root: base directory of the county-wise pickles
+    @param out: base directory of the Parquet files
+    @param nProcesses: no. of worker processes for the conversion
+    """
+    fname, dynamic = CNTY_TABLES[table]
+    if dynamic:
+        files = glob(f'{root}/*/*/{fname}/{fname}_*.pickle')
+    else:
+        files = glob(f'{root}/*/*/{fname}.pickle')
+    jobs = []
+    for src in files:
+        parts = os.path.relpath(src, root).split(os.sep)
+        dst = f'{out}/{table}/state={int(parts[0])}/cnty={int(parts[1])}'
+        if dynamic:
+            date = os.path.basename(src)[len(fname) + 1: -len('.pickle')]
+            dst += f'/date={strdate2int(date)}'
+        dst += '/data.parquet'
+        if overwrite or not os.path.exists(dst):
+            jobs.append((src, dst))
+    if nProcesses > 1 and len(jobs) > 1:
+        with Pool(nProcesses) as pool:
+            pool.map(_pickle_to_parquet, jobs, chunksize=16)
+    else:
+        list(map(_pickle_to_parquet, jobs))
+    return len(jobs)
+
+def connect_cnty_db(root=IO['cnty_parquet'], db=':memory:'):
+    """
+    Open a DuckDB database with a view over the Parquet files of each
+    exported county-wise table (see `export_cnty_parquet`), with the columns
+    `state`, `cnty` (& `date` as yymmdd int for daily/weekly tables) taken
+    from the folders. DuckDB reads only the columns used by a query & skips
+    the files & row groups excluded by its filters, so queries over any
+    region & period run without loading the tables into memory.
+    """
+    import duckdb
+    con = duckdb.connect(db)
+    for table in CNTY_TABLES:
+        path = f'{root}/{table}'
+        if os.path.exists(path):
+            con.execute(f"""
+                CREATE OR REPLACE VIEW {table} AS
+                SELECT * FROM read_parquet('{path}/**/*.parquet',
+                                           hive_partitioning = true,
+                                           union_by_name = true)""")
+    return con
+
+def query_cnty(sql, con=None):
+    """
+    Run an SQL query on the county-wise views & get the result as a table,
+    e.g. `query_cnty('SELECT date, SUM(raw_visit_counts) FROM patterns
+    WHERE state = 17 AND cnty IN (31, 43) GROUP BY date')`.
+    @param con: database connection; a shared one is opened if not given
+    """
+    global CNTY_DB
+    if con is None:
+        if CNTY_DB is None:
+            CNTY_DB = connect_cnty_db()
+        con = CNTY_DB
+    return con.execute(sql).df()
+
+
+#%% SEM BOOTSTRAP -------------------------------------------------------------
+
+# pristine (never fitted) SEM models of this process, keyed by their formula,
+# so that the formula is parsed only once across the bootstrap replicates
+SEM_MODELS = {}
+
+def fit_sem(formula, data, check=False):
+    """
+    Fit an SEM (semopy) model on the given data & get its parameter table.
+    Each fit uses a fresh copy of the parsed model, since a fitted model keeps
+    the starting values of the first dataset it was fitted on.
+    @param check: whether to raise a ValueError if the solution is not
+    admissible, i.e. if the objective or the estimates are not finite or the
+    model-implied covariance matrix is not positive definite (semopy does not
+    report whether the optimizer converged)
+    """
+    import semopy as sem
+    from semopy import inspector
+    if formula not in SEM_MODELS:
+        SEM_MODELS[formula] = sem.Model(formula)
+    model = copy.deepcopy(SEM_MODELS[formula])
+    model.load_dataset(data)
+    opt = sem.optimizer.Optimizer(model)
+    fun = opt.optimize()
+    if check:
+        if not (np.isfinite(fun) and np.isfinite(opt.params).all()):
+            raise ValueError('SEM objective or estimates are not finite')
+        # raises a LinAlgError if not positive definite
+        np.linalg.cholesky(opt.get_sigma()[0])
+    return inspector.inspect(opt)
+
+def _sem_replicates(args):
+    """
+    Fit an SEM model on bootstrap samples of the given data (worker of
+    `bootstrap_sem`), each drawn with its own seed by resampling the units
+    (e.g. ZIPs) with replacement along with all of their rows. The replicates
+    without an admissible solution (see `fit_sem`) are dropped.
+    @return: table of the estimates with a column per replicate
+    """
+    formula, data, unit, seeds = args
+    groups = list(data.groupby(unit).indices.values())
+    estimates = {}
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        idx = np.concatenate([groups[i] for i in
+                              rng.integers(0, len(groups), len(groups))])
+        try:
+            params = fit_sem(formula, data.iloc[idx], check=True)
+        except (np.linalg.LinAlgError, ValueError):
+            continue
+        estimates[seed.spawn_key[-1]] = (
+            params.set_index(['lval', 'op', 'rval'])['Estimate'])
+    return pd.DataFrame(estimates)
+
+def bootstrap_sem(formula, data, by=None, unit='zip', n_boot=1000, alpha=0.05,
+                  seed=0, nProcesses=4, chunksize=25):
+    """
+    Fit an SEM model & get bootstrap percentile confidence intervals of its
+    parameters by refitting it on resamples of the units. The replicates of
+    all the cases are run together in a process pool. Each replicate has its
+    own seed derived from `seed`, the case & its no., so the results do not
+    depend on `nProcesses` or `chunksize`.
+    @param formula: SEM model description in semopy syntax
+    @param data: data of all the cases
+    @param by: column giving the case of each row (e.g. 'date' or 'week'),
+    with a model fitted to each case; one model on all the data if None
+    @param unit: column giving the sampling unit of the rows
+    @param n_boot: no. of bootstrap replicates per case
+    @param alpha: significance level of the (1 - alpha) intervals
+    @param chunksize: no. of replicates fitted by a worker in one task
+    @return params: parameter table (as given by `inspector.inspect`) with a
+    `case` column & the columns `CI lower`, `CI upper`, `Boot. Std. Err` and
+    `n_boot` (no. of replicates with an admissible solution, see `fit_sem`)
+    """
+    cases = data.groupby(by) if by is not None else [(None, data)]
+    root = np.random.SeedSequence(seed)
+    res, jobs = [], []
+    for i, (case, df) in enumerate(cases):
+        try:
+            params = fit_sem(formula, df)
+        except np.linalg.LinAlgError:
+            if by is None:
+                raise
+            print(f'LinAlgError in {case}')
+            continue
+        params.insert(0, 'case', case)
+        res.append(params)
+        seeds = np.random.SeedSequence(root.entropy, spawn_key=(i,)).spawn(n_boot)
+        jobs += [(len(res) - 1, (formula, df, unit, seeds[j: j + chunksize]))
+                 for j in range(0, n_boot, chunksize)]
+    if len(res) == 0:
+        return pd.DataFrame()
+    if nProcesses > 1:
+        with Pool(nProcesses) as pool:
+            reps = pool.map(_sem_replicates, [x[1] for x in jobs], chunksize=1)
+    else:
+        reps = list(map(_sem_replicates, [x[1] for x in jobs]))
+    for k, params in enumerate(res):
+        est = pd.concat([r for (i, _), r in zip(jobs, reps) if i == k], axis=1)
+        est = est.reindex(pd.MultiIndex.from_frame(params[['lval', 'op', 'rval']]))
+        ci = pd.DataFrame({
+            'CI lower': np.nanquantile(est, alpha / 2, axis=1),
+            'CI upper': np.nanquantile(est, 1 - alpha / 2, axis=1),
+            'Boot. Std. Err': np.nanstd(est, axis=1, ddof=1),
+            'n_boot': est.shape[1]})
+        res[k] = pd.concat([params.reset_index(drop=True), ci], axis=1)
+    return pd.concat(res).reset_index(drop=True)
+
+
+#%% COUNTY PARTITIONS ---------------------------------------------------------
+
+# folder of the county partitions inside the folder of a region, each one
+# holding the usual city files of a single county (see `get_cnty_parts`)
+CNTY_PART_DIR = 'counties'
+
+def get_cnty_parts(city, cntys=None):
+    """
+    Split a region (e.g. a whole state) into one city per county, each with
+    its own folder inside the region's folder, so that the data of large
+    regions can be written (see `make_city_data.ipynb`) & processed county by
+    county with the usual loaders (see `map_cnty_parts`).
+    @param cntys: names of the counties (keys of `city.counties`) to be kept
+    """
+    parts = []
+    for name, (state, cnty) in city.counties.items():
+        if cntys is not None and name not in cntys:
+            continue
+        part = City(city.key, {'name': city.name_, 'events': city.events,
+                               'counties': {name: [state, cnty]}})
+        part.dir = f'{city.dir}/{CNTY_PART_DIR}/{state:02}{cnty:03}'
+        parts.append(part)
+    return parts
+
+def _map_cnty_part(args):
+    """
+    Run a function on a county partition (worker of `map_cnty_parts`).
+    """
+    func, part, kwargs = args
+    return func(part, **kwargs)
+
+def _sum_parts(results, batch=8):
+    """
+    Add up tables of partial aggregates as they come (see `map_cnty_parts`),
+    regrouping the running total once per `batch` partials.
+    """
+    total, pending = None, []
+    for res in results:
+        pending.append(res)
+        if len(pending) == batch:
+            total, pending = _add_parts([total] + pending), []
+    if pending:
+        total = _add_parts([total] + pending)
+    return total.sort_index() if total is not None else None
+
+def _add_parts(parts):
+    """
+    Sum tables of partial aggregates by their index (`None`s are skipped).
+    """
+    parts = [x for x in parts if x is not None]
+    if len(parts) == 1:
+        return parts[0]
+    return (pd.concat(parts)
+            .groupby(level=list(range(parts[0].index.nlevels))).sum())
+
+def map_cnty_parts(city, func, cntys=None, nProcesses=1, batch=8, **kwargs):
+    """
+    Run `func(part, **kwargs)` on each county partition of a region & add up
+    the tables of additive partial aggregates (e.g. sums by zip & date) it
+    returns, indexed by their keys. The partials are added in batches as
+    they are ready, so only the running total & a few partials are in memory
+    at a time, besides the data of a partition per process, whatever the
+    size of the region. The result is the same as that of `func` on the
+    whole region when its aggregates only depend on the rows being summed,
+    e.g. the `agg_*_zip` functions (zips spanning several counties are summed
+    over them).
+    @param func: function of a city giving a table of partial aggregates;
+    must be importable (e.g. from this module) if `nProcesses` > 1
+    @param cntys: names of the counties to be processed (all by default)
+    @param batch: no. of partials added to the running total at once
+    @raise FileNotFoundError: if any of the partitions is not written yet
+    """
+    parts = get_cnty_parts(city, cntys)
+    missing = [x.dir for x in parts if not os.path.isdir(x.dir)]
+    if missing:
+        raise FileNotFoundError(f'{len(missing)} county partitions of '
+                                f'{city} are not written, e.g. {missing[0]}')
+    jobs = [(func, part, kwargs) for part in parts]
+    if nProcesses > 1:
+        with Pool(nProcesses) as pool:
+            return _sum_parts(pool.imap_unordered(_map_cnty_part, jobs), batch)
+    return _sum_parts(map(_map_cnty_part, jobs), batch)
+
+@instrument
+def agg_acs_zip(city, zips=None):
+    """
+    Census sums of the city by zip code (see `sum_acs_by_zip`); the sums of
+    `map_cnty_parts` give the zip-level table with `finalize_acs_zip`.
+    """
+    acs = city.acs if hasattr(city, 'acs') else load_acs(city)
+    return sum_acs_by_zip(acs, zips)
+
+@instrument
+def agg_exp_zip(city, exp_var='cei', start=200301):
+    """
+    Daily exposure visits & visit-weighted exposure metric (`tot_<exp_var>`)
+    of the city's POIs summed by zip code of the POI.
+    """
+    exp = city.exp if hasattr(city, 'exp') else load_exposure(city, [exp_var])
+    pois = city.pois if hasattr(city, 'pois') else load_pois(city)
+    return (exp.reset_index()
+            .pipe(lambda x: x[x['date'] >= start])
+            .merge(pois['zip'], left_on='poi_id', right_index=True)
+            .assign(**{'tot_'+exp_var: lambda x: x[exp_var]*x['exp_visits']})
+            .groupby(['zip', 'date'])[['exp_visits', 'tot_'+exp_var]].sum())
+
+@instrument
+def agg_sd_zip(city):
+    """
+    Daily social distancing devices (total & at home) & device-weighted time
+    at home (`tot_time_home`) summed by zip code of the home CBG.
+    """
+    sd = city.sd if hasattr(city, 'sd') else load_social_dist(city)
+    return (map_cbg_zip(sd.reset_index())
+            .assign(tot_time_home = lambda x: x['time_home']*x['tot_dev'])
+            .drop(columns=['cbg', 'time_home'])
+            .groupby(['zip', 'date']).sum())
+
+@instrument
+def agg_od_zip(city):
+    """
+    Weekly visitors from each home zip to the POIs of each POI zip.
+    """
+    od_zip = city.od_zip if hasattr(city, 'od_zip') else load_od_zip(city)
+    pat = city.pat if hasattr(city, 'pat') else load_pat(city, [])['pat']
+    return (od_zip.rename(columns={'zip': 'home_zip'})
+            .merge(pat[['row_id', 'week', 'zip']]
+                   .rename(columns={'zip': 'poi_zip'}), on=['row_id', 'week'])
+            .groupby(['week', 'home_zip', 'poi_zip'])[['visitors']].sum())
+
+
 #%% MAIN ----------------------------------------------------------------------
 if __name__ == '__main__':
     cities = load_cities()